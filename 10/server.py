@@ -1,8 +1,15 @@
 from collections import namedtuple, defaultdict
+import argparse
+import hashlib
 import socket
 import socketserver
 
-File = namedtuple('File', 'data rev prev')
+# revs[n - 1] is revision n, as stored in blobs
+File = namedtuple('File', 'revs')
+# base[:prefix] + middle + base[len(base) - suffix:], where base is the blob
+# of the revision before; depth deltas and size bytes of middles lead back
+# to a full copy
+Delta = namedtuple('Delta', 'base prefix suffix middle depth size')
 Dir = namedtuple('Dir', 'contents')
 Node = namedtuple('Node', 'filepart dirpart')
 
@@ -11,6 +18,75 @@ def mknode():
 
 root = mknode()
 
+# every distinct content by sha256, so a content held by several files or
+# revisions is stored once
+blobs = {}
+
+# store a revision as a change to the one before, when that is small
+use_deltas = False
+MAX_DEPTH = 32
+
+def add_revision(file, data):
+    key = hashlib.sha256(data).digest()
+    blob = blobs.get(key)
+    if blob is None:
+        blob = blobs[key] = encode(data, file.revs)
+    elif file.revs and file.revs[-1] is blob:
+        return
+    file.revs.append(blob)
+
+def encode(data, revs):
+    if not use_deltas or not revs:
+        return data
+    last = revs[-1]
+    depth, size = (last.depth, last.size) if type(last) is Delta else (0, 0)
+    # a full copy is kept every so often, so a revision is never more than
+    # MAX_DEPTH splices away and the splices never add up to much more than
+    # copying it
+    if depth >= MAX_DEPTH:
+        return data
+    prev = content(last)
+    limit = min(len(data), len(prev))
+    prefix = match_length(data, prev, limit, False)
+    suffix = match_length(data, prev, limit - prefix, True)
+    middle = data[prefix:len(data) - suffix]
+    if (size + len(middle)) * 2 > len(data):
+        return data
+    return Delta(last, prefix, suffix, middle, depth + 1, size + len(middle))
+
+def match_length(a, b, limit, from_end):
+    # how many bytes a and b share at the start (or end), comparing growing
+    # blocks and then halving the one that differs, so the work is memcmp
+    def same(i, j):
+        if from_end:
+            return a[len(a) - j:len(a) - i] == b[len(b) - j:len(b) - i]
+        return a[i:j] == b[i:j]
+    n = 0
+    step = 64
+    while n < limit:
+        m = min(limit, n + step)
+        if not same(n, m):
+            while m - n > 1:
+                mid = (n + m) // 2
+                if same(n, mid):
+                    n = mid
+                else:
+                    m = mid
+            return n
+        n = m
+        step = min(step * 2, 1 << 20)
+    return n
+
+def content(blob):
+    deltas = []
+    while type(blob) is Delta:
+        deltas.append(blob)
+        blob = blob.base
+    data = blob
+    for delta in reversed(deltas):
+        data = data[:delta.prefix] + delta.middle + data[len(data) - delta.suffix:]
+    return data
+
 def get_file(filename):
     node = root
     path = filename.split(b'/')[1:]
@@ -24,6 +100,13 @@ def get_file(filename):
         node = node.dirpart.contents[name]
     return node, parent, name
 
+# bytes allowed in file contents; translate deletes them and anything left
+# over is not text
+TEXT_BYTES = b'\t\n\x0b\r' + bytes(range(32, 128))
+
+# most a PUT buffer starts at, before any of the data has arrived
+PUT_BUFFER = 16 << 20
+
 def validate_filename(filename, allowdir=False):
     if not filename.startswith(b'/'):
         return False
@@ -85,28 +168,29 @@ class Handler(socketserver.BaseRequestHandler):
                 except ValueError:
                     self.request.sendall(b'ERR invalid length\n')
                     continue
-                data, trail = trail[:length], trail[length:]
-                while len(data) < length:
-                    chunk = self.request.recv(length - len(data))
-                    if not chunk:
-                        return
-                    data += chunk
-                    trail = b''
-                non_text = False
-                for c in data:
-                    if c < 32 and c != 10 and c != 9 and c != 11 and c != 13 or c > 127:
-                        non_text = True
-                        self.request.sendall(b'ERR non-text content\n')
-                        break
-                if non_text:
+                # read straight into the buffer the content is kept in,
+                # growing it as the data comes in rather than on the
+                # client's word for the length
+                data = bytearray(min(length, PUT_BUFFER))
+                got = min(len(trail), length)
+                data[:got] = trail[:got]
+                trail = trail[got:]
+                while got < length:
+                    if got == len(data):
+                        data.extend(bytes(min(len(data), length - got)))
+                    with memoryview(data) as view:
+                        while got < len(data):
+                            n = self.request.recv_into(view[got:])
+                            if not n:
+                                return
+                            got += n
+                if data.translate(None, TEXT_BYTES):
+                    self.request.sendall(b'ERR non-text content\n')
                     continue
-                if node.filepart is not None:
-                    if data != node.filepart.data:
-                        node = parent.contents[name] = node._replace(filepart=File(data, node.filepart.rev + 1, node.filepart))
-                else:
-                    node = parent.contents[name] = node._replace(filepart=File(data, 1, None))
-                self.request.send(b'OK r' + str(node.filepart.rev).encode('ascii') + b'\n')
-                self.request.sendall(b'READY\n')
+                if node.filepart is None:
+                    node = parent.contents[name] = node._replace(filepart=File([]))
+                add_revision(node.filepart, data)
+                self.request.sendall(b'OK r' + str(len(node.filepart.revs)).encode('ascii') + b'\nREADY\n')
             elif cmd == b'GET':
                 if len(args) == 0 or len(args) > 2:
                     self.request.sendall(b'ERR usage: GET file [revision]\n')
@@ -129,20 +213,21 @@ class Handler(socketserver.BaseRequestHandler):
                 if node.filepart is None:
                     self.request.sendall(b'ERR no such file\n')
                 else:
-                    file = node.filepart
-                    if want_rev is not None:
-                        if want_rev < 1 or want_rev > file.rev:
-                            self.request.sendall(b'ERR no such revision\n')
-                            continue
-                        while file is not None and file.rev != want_rev:
-                            file = file.prev
-                    if file is None:
+                    revs = node.filepart.revs
+                    if want_rev is None:
+                        want_rev = len(revs)
+                    if want_rev < 1 or want_rev > len(revs):
                         self.request.sendall(b'ERR no such revision\n')
                         continue
-                    data = file.data
-                    self.request.send(b'OK ' + str(len(data)).encode('ascii') + b'\n')
-                    self.request.send(data)
-                    self.request.sendall(b'READY\n')
+                    data = content(revs[want_rev - 1])
+                    header = b'OK ' + str(len(data)).encode('ascii') + b'\n'
+                    if len(data) < 1 << 16:
+                        # one write, so the reply is not held back by Nagle
+                        self.request.sendall(header + data + b'READY\n')
+                    else:
+                        self.request.sendall(header)
+                        self.request.sendall(data)
+                        self.request.sendall(b'READY\n')
             elif cmd == b'LIST':
                 if len(args) != 1:
                     self.request.sendall(b'ERR usage: LIST dir\n')
@@ -156,7 +241,7 @@ class Handler(socketserver.BaseRequestHandler):
                 self.request.send(b'OK ' + str(len(entries)).encode('ascii') + b'\n')
                 for name, node in entries:
                     if node.filepart is not None:
-                        self.request.send(name + b' r' + str(node.filepart.rev).encode('ascii') + b'\n')
+                        self.request.send(name + b' r' + str(len(node.filepart.revs)).encode('ascii') + b'\n')
                     else:
                         self.request.send(name + b'/ DIR\n')
                 self.request.sendall(b'READY\n')
@@ -170,4 +255,9 @@ class Handler(socketserver.BaseRequestHandler):
 class Server(socketserver.ThreadingTCPServer):
     allow_reuse_address = True
 
-Server(('0.0.0.0', 9999), Handler).serve_forever()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delta', action='store_true')
+    args = parser.parse_args()
+    use_deltas = args.delta
+    Server(('0.0.0.0', 9999), Handler).serve_forever()
@@ -1,16 +1,118 @@
+import argparse
 import bisect
 from collections import namedtuple
+import logging
+import os
+import pickle
+import random
+import signal
+import socket
 import struct
 import socketserver
+import sys
 import time
 import threading
 
+log = logging.getLogger('speed-daemon')
+
 class ProtocolError(Exception):
 
     def __init__(self, msg):
         self.msg = msg
 
+class Counts:
+
+    def __init__(self, buckets):
+        self.counters = {}
+        self.latency = [0] * buckets
+
+    def add(self, other):
+        for name, count in list(other.counters.items()):
+            self.counters[name] = self.counters.get(name, 0) + count
+        self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+
+class Metrics:
+
+    # Each thread counts into its own Counts, so recording takes no lock.
+    # The lock is only taken on a thread's first record, when a finished
+    # connection's counts are folded in, and by report.
+
+    # latency buckets are powers of two in milliseconds, the last one
+    # collects everything slower
+    LATENCY_BUCKETS = 16
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.live = []
+        self.retired = Counts(self.LATENCY_BUCKETS + 1)
+
+    def counts(self):
+        try:
+            return self.local.counts
+        except AttributeError:
+            counts = self.local.counts = Counts(self.LATENCY_BUCKETS + 1)
+            with self.lock:
+                self.live.append(counts)
+            return counts
+
+    def incr(self, name):
+        counters = self.counts().counters
+        counters[name] = counters.get(name, 0) + 1
+
+    def observe_latency(self, seconds):
+        bucket = min(int(seconds * 1000).bit_length(), self.LATENCY_BUCKETS)
+        self.counts().latency[bucket] += 1
+
+    def retire(self):
+        # called as a connection's thread finishes
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            del self.local.counts
+            with self.lock:
+                self.live.remove(counts)
+                self.retired.add(counts)
+
+    def report(self):
+        total = Counts(self.LATENCY_BUCKETS + 1)
+        with self.lock:
+            total.add(self.retired)
+            for counts in self.live:
+                total.add(counts)
+        counters = total.counters
+        latency = total.latency
+        lines = ['%s=%d' % item for item in sorted(counters.items())]
+        for bucket, count in enumerate(latency):
+            if not count:
+                continue
+            if bucket == self.LATENCY_BUCKETS:
+                label = '>=%dms' % (1 << (bucket - 1))
+            else:
+                label = '<%dms' % (1 << bucket)
+            lines.append('latency %s=%d' % (label, count))
+        return '\n'.join(lines)
+
+metrics = Metrics()
+
+# Fraction of hot path events that get a debug log line. Zero disables
+# them entirely, SIGUSR1 toggles it at runtime
+DEBUG_SAMPLE_RATE = 0.01
+debug_sample = 0.0
+
+# call sites test debug_sample first, so a disabled log costs no call
+def sampled():
+    return random.random() < debug_sample
+
+def toggle_debug(signum, frame):
+    global debug_sample
+    debug_sample = 0.0 if debug_sample else DEBUG_SAMPLE_RATE
+    log.info("Debug sample rate %s", debug_sample)
+
+def dump_metrics(signum, frame):
+    log.info("Metrics:\n%s", metrics.report())
+
 beat_counter = {}
+beat_lock = threading.Lock()
 
 class BeatCounter:
 
@@ -29,22 +131,33 @@ class BeatCounter:
         self.client.send(0x41, b'')
 
 def register_heartbeat(client, interval):
-    beat_counter[id(client)] = BeatCounter(client, interval)
+    with beat_lock:
+        beat_counter[id(client)] = BeatCounter(client, interval)
 
 def unregister_heartbeat(client):
-    if id(client) in beat_counter:
-        del beat_counter[id(client)]
+    with beat_lock:
+        if id(client) in beat_counter:
+            del beat_counter[id(client)]
 
 def heartbeat_thread():
     while True:
         time.sleep(.1)
-        for counter in beat_counter.values():
-            counter.beat()
+        with beat_lock:
+            counters = list(beat_counter.values())
+        for counter in counters:
+            try:
+                counter.beat()
+            except Exception:
+                # client went away, its handler will unregister it
+                pass
 
 class Road:
 
     def __init__(self, road_id):
         self.id = road_id
+        # guards all state of this road, held by the camera and dispatcher
+        # threads for the duration of each operation
+        self.lock = threading.Lock()
         self.limit = None
         self.camera_to_pos = {}
         self.position_to_camera = {}
@@ -69,8 +182,7 @@ class Road:
         # If we were storing tickets, flush them now
         tickets = list(self.stored_tickets)
         self.stored_tickets = []
-        for ticket in tickets:
-            self.send_ticket(ticket)
+        return [out for out in map(self.send_ticket, tickets) if out is not None]
 
     def remove_camera(self, camera):
         pos = self.camera_to_pos[id(camera)]
@@ -80,7 +192,7 @@ class Road:
     def remove_dispatcher(self, dispatcher):
         del self.dispatchers[id(dispatcher)]
 
-    def camera_observation(self, camera, plate, timestamp):
+    def camera_observation(self, camera, plate, timestamp, observed):
         pos = self.camera_to_pos[id(camera)]
         if plate not in self.car_observations:
             # store timestamp and pos in two synchronised lists
@@ -89,36 +201,74 @@ class Road:
         idx = bisect.bisect(obs_ts, timestamp)
         obs_ts.insert(idx, timestamp)
         obs_pos.insert(idx, pos)
-        print("Observations:", plate, list(zip(obs_ts, obs_pos)))
+        if debug_sample and sampled():
+            log.debug("Observations: %s %s", plate, list(zip(obs_ts, obs_pos)))
+        outgoing = []
         for speed, obs1, obs2 in get_speeds(idx, obs_ts, obs_pos):
-            print("Speed", speed, obs1, obs2)
+            if debug_sample and sampled():
+                log.debug("Speed %s %s %s", speed, obs1, obs2)
             if round(speed) > self.limit:
-                self.create_ticket(plate, speed, obs1, obs2)
+                out = self.create_ticket(plate, speed, obs1, obs2, observed)
+                if out is not None:
+                    outgoing.append(out)
+        return outgoing
 
-    def create_ticket(self, plate, speed, obs1, obs2):
+    def create_ticket(self, plate, speed, obs1, obs2, observed):
         speed_int = int(round(speed * 100))
-        ticket = (plate, speed_int, obs1, obs2)
+        ticket = (plate, speed_int, obs1, obs2, observed)
+        metrics.incr('tickets_created')
+        if upstream is not None:
+            # in a worker, forwarded to the accepting process, which has
+            # the dispatchers and the ticket-day dedup
+            return self.id, ticket
+        return self.file_ticket(ticket)
+
+    def file_ticket(self, ticket):
         # send now, or store for later
         if self.dispatchers:
-            self.send_ticket(ticket)
+            return self.send_ticket(ticket)
         else:
-            print("Store ticket", ticket)
+            if debug_sample and sampled():
+                log.debug("Store ticket %s", ticket)
+            metrics.incr('tickets_stored')
             self.stored_tickets.append(ticket)
 
     def send_ticket(self, ticket):
-        print("Maybe send ticket", ticket)
-        plate, speed, obs1, obs2 = ticket
+        # Returns (dispatcher, message, observed) for deliver, which writes
+        # it once the road lock is released, so a dispatcher that stops
+        # reading holds up no one but the thread sending to it
+        plate, speed, obs1, obs2, observed = ticket
         pos1, time1 = obs1
         pos2, time2 = obs2
-        if should_send_ticket(plate, time1, time2):
-            print("Will send ticket", ticket)
+        if not should_send_ticket(plate, time1, time2):
+            metrics.incr('tickets_deduplicated')
+        else:
+            if debug_sample and sampled():
+                log.debug("Will send ticket %s", ticket)
             # choose arbitrarily
             dispatcher = next(iter(self.dispatchers.values()))
             plate_bytes = plate.encode('ascii')
             msg = struct.pack('!B', len(plate_bytes))
             msg += plate_bytes
             msg += struct.pack('!HHIHIH', self.id, pos1, time1, pos2, time2, speed)
+            return dispatcher, msg, observed
+
+def forward(tickets):
+    for ticket in tickets:
+        upstream.send(pickle.dumps(ticket))
+        metrics.incr('tickets_forwarded')
+
+def deliver(outgoing):
+    for dispatcher, msg, observed in outgoing:
+        try:
             dispatcher.send(0x21, msg)
+        except OSError as e:
+            # the dispatcher went away after it was picked
+            log.info("Lost ticket: %s", e)
+            metrics.incr('tickets_lost')
+            continue
+        metrics.incr('tickets_sent')
+        metrics.observe_latency(time.monotonic() - observed)
 
 # Returns up to two speed observations
 # tuple of: (speed, first_obs, second_obs)
@@ -142,70 +292,116 @@ def get_speeds(idx, times, positions):
         t = new_time - time
         yield ((dist / t) * 3600, (pos, time), (new_pos, new_time))
 
+# Road state is sharded by road: each Road carries its own lock, so
+# observations on different roads never contend. Lock order is
+# roads_lock -> Road.lock -> tickets_lock. No socket is written with any
+# of them held.
+#
+# With --workers, roads are also split across processes. The accepting
+# process hands each camera's connection to the worker that owns its road,
+# and keeps the dispatchers, the stored tickets and car_tickets, so the
+# dedup still has a single authority. Workers forward their tickets to it.
+
 # maps cameras to a Road object
 camera_to_road = {}
 # maps dispatchers to a list of roads
 dispatcher_roads = {}
 # maps roads to Road objects
 roads = {}
+# guards the three registries above
+roads_lock = threading.Lock()
 # maps cars to days ticketed
 car_tickets = {}
+# ticket days span roads, so the dedup has a single authority
+tickets_lock = threading.Lock()
 
 def should_send_ticket(plate, time1, time2):
-    if plate not in car_tickets:
-        car_tickets[plate] = set()
     day_start = time1 // 86400
     day_end = time2 // 86400
-    days = set()
-    for day in range(day_start, day_end + 1):
-        days.add(day)
-        if day in car_tickets[plate]:
-            return False
-    car_tickets[plate].update(days)
+    with tickets_lock:
+        if plate not in car_tickets:
+            car_tickets[plate] = set()
+        days = set()
+        for day in range(day_start, day_end + 1):
+            days.add(day)
+            if day in car_tickets[plate]:
+                return False
+        car_tickets[plate].update(days)
     return True
 
-def register_camera(client, road, mile, limit):
-    print("Register camera", { 'client': id(client), 'road': road, 'mile': mile, 'limit': limit })
+def get_road(road):
+    # caller must hold roads_lock
     if road not in roads:
         roads[road] = Road(road)
-    road_obj = roads[road]
-    road_obj.set_limit(limit)
-    road_obj.add_camera(client, mile)
-    camera_to_road[id(client)] = road_obj
+    return roads[road]
+
+def register_camera(client, road, mile, limit):
+    if debug_sample:
+        log.debug("Register camera %s", { 'client': id(client), 'road': road, 'mile': mile, 'limit': limit })
+    with roads_lock:
+        road_obj = get_road(road)
+        with road_obj.lock:
+            road_obj.set_limit(limit)
+            road_obj.add_camera(client, mile)
+        camera_to_road[id(client)] = road_obj
 
 def unregister_camera(client):
-    camera_to_road[id(client)].remove_camera(client)
-    del camera_to_road[id(client)]
+    with roads_lock:
+        road_obj = camera_to_road.pop(id(client))
+        with road_obj.lock:
+            road_obj.remove_camera(client)
 
 def register_dispatcher(client, in_roads):
-    print("Register dispatcher", { 'client': id(client), 'roads': in_roads })
+    if debug_sample:
+        log.debug("Register dispatcher %s", { 'client': id(client), 'roads': in_roads })
     road_objs = []
-    for road in in_roads:
-        if road not in roads:
-            roads[road] = Road(road)
-        road_objs.append(roads[road])
-        roads[road].add_dispatcher(client)
-    dispatcher_roads[id(client)] = road_objs
+    outgoing = []
+    with roads_lock:
+        for road in in_roads:
+            road_obj = get_road(road)
+            road_objs.append(road_obj)
+            with road_obj.lock:
+                outgoing += road_obj.add_dispatcher(client)
+        dispatcher_roads[id(client)] = road_objs
+    deliver(outgoing)
 
 def unregister_dispatcher(client):
-    road_objs = dispatcher_roads[id(client)]
-    for road in road_objs:
-        road.remove_dispatcher(client)
-    del dispatcher_roads[id(client)]
+    with roads_lock:
+        road_objs = dispatcher_roads.pop(id(client))
+        for road in road_objs:
+            with road.lock:
+                road.remove_dispatcher(client)
 
 def camera_observation(camera, plate, timestamp):
-    print("Observation", { 'camera': id(camera), 'plate': plate, 'timestamp': timestamp })
+    observed = time.monotonic()
+    metrics.incr('observations')
+    if debug_sample and sampled():
+        log.debug("Observation %s", { 'camera': id(camera), 'plate': plate, 'timestamp': timestamp })
+    # only this camera's thread changes its own entry
     road = camera_to_road[id(camera)]
-    road.camera_observation(camera, plate, timestamp)
+    with road.lock:
+        outgoing = road.camera_observation(camera, plate, timestamp, observed)
+    if upstream is not None:
+        forward(outgoing)
+    else:
+        deliver(outgoing)
 
 class Handler(socketserver.BaseRequestHandler):
 
+    # messages to read again before the socket's own, for a camera handed
+    # over by the accepting process
+    replay = b''
+
     def handle(self):
 
         self.client_type = None
         self.heartbeat_known = False
+        self.send_lock = threading.Lock()
+        # what was read before IAmCamera, for the worker the camera goes to
+        self.seen = bytearray() if worker_links else None
+        self.handed_off = False
 
-        while True:
+        while not self.handed_off:
             try:
                 self.main_loop()
             except ProtocolError as e:
@@ -218,7 +414,7 @@ class Handler(socketserver.BaseRequestHandler):
                     pass
                 break
             except Exception as e:
-                print("Exception:", e)
+                log.info("Exception: %s", e)
                 # we still need to handle teardown
                 break
 
@@ -228,6 +424,7 @@ class Handler(socketserver.BaseRequestHandler):
         elif self.client_type == 'dispatcher':
             unregister_dispatcher(self)
         unregister_heartbeat(self)
+        metrics.retire()
 
     def main_loop(self):
         msg_type = self.read_u8()
@@ -253,6 +450,9 @@ class Handler(socketserver.BaseRequestHandler):
             road = self.read_u16()
             mile = self.read_u16()
             limit = self.read_u16()
+            if worker_links:
+                self.hand_off(road)
+                return
             register_camera(self, road, mile, limit)
             self.client_type = 'camera'
         elif msg_type == 0x81:
@@ -263,11 +463,20 @@ class Handler(socketserver.BaseRequestHandler):
             roads = []
             for _  in range(numroads):
                 roads.append(self.read_u16())
+            self.seen = None
             register_dispatcher(self, roads)
             self.client_type = 'dispatcher'
         else:
             raise ProtocolError('Unknown message type')
 
+    def hand_off(self, road):
+        # the worker reads the messages in seen again, IAmCamera last, and
+        # serves the camera from there. This handler only closes its copy
+        unregister_heartbeat(self)
+        link = worker_links[road % len(worker_links)]
+        socket.send_fds(link, [bytes(self.seen)], [self.request.fileno()])
+        self.handed_off = True
+
     def read_u8(self):
         return self._read(1)[0]
 
@@ -285,6 +494,9 @@ class Handler(socketserver.BaseRequestHandler):
 
     def _read(self, size):
         buf = b''
+        if self.replay:
+            buf = self.replay[:size]
+            self.replay = self.replay[size:]
         while len(buf) < size:
             remaining = size - len(buf)
             recv = self.request.recv(remaining)
@@ -292,18 +504,115 @@ class Handler(socketserver.BaseRequestHandler):
             if not len(recv):
                 raise Exception('Unable to read')
             buf += recv
+        if self.seen is not None:
+            self.seen += buf
         return buf
 
     def send(self, msg_id, data):
-        self.request.send(struct.pack('!B', msg_id))
-        self.request.sendall(data)
+        # tickets and heartbeats are written from other threads
+        with self.send_lock:
+            self.request.sendall(struct.pack('!B', msg_id) + data)
 
-class Server(socketserver.ThreadingTCPServer):
-    allow_reuse_address = True
+class CameraHandler(Handler):
+
+    # a camera handed over to a worker, with the messages the accepting
+    # process read from it
 
-t = threading.Thread(target=heartbeat_thread)
-t.daemon = True
-t.start()
+    def __init__(self, request, replay):
+        self.replay = replay
+        super().__init__(request, None, None)
 
-server = Server(('0.0.0.0', 9999), Handler)
-server.serve_forever()
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+# the accepting process's ends of its links to the workers
+worker_links = []
+# a worker's link to the accepting process
+upstream = None
+
+def start_workers(count):
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET) for _ in range(count)]
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for other, (parent, child) in enumerate(pairs):
+                    parent.close()
+                    if other != index:
+                        child.close()
+                serve_worker(pairs[index][1])
+            finally:
+                os._exit(1)
+        pids.append(pid)
+    for parent, child in pairs:
+        child.close()
+        worker_links.append(parent)
+    return pids
+
+def serve_worker(link):
+    global upstream
+    upstream = link
+    start_heartbeats()
+    while True:
+        replay, fds, flags, addr = socket.recv_fds(link, 1024, 1)
+        if not fds:
+            # the accepting process has gone
+            return
+        sock = socket.socket(fileno=fds[0])
+        t = threading.Thread(target=CameraHandler, args=(sock, replay))
+        t.daemon = True
+        t.start()
+
+def file_tickets(link):
+    # tickets forwarded by one worker
+    while True:
+        data = link.recv(1024)
+        if not data:
+            log.info("Worker exited")
+            server.shutdown()
+            return
+        road_id, ticket = pickle.loads(data)
+        with roads_lock:
+            road = get_road(road_id)
+        with road.lock:
+            out = road.file_ticket(ticket)
+        if out is not None:
+            deliver([out])
+
+def start_heartbeats():
+    t = threading.Thread(target=heartbeat_thread)
+    t.daemon = True
+    t.start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+    signal.signal(signal.SIGUSR1, toggle_debug)
+    signal.signal(signal.SIGUSR2, dump_metrics)
+
+    # fork before any thread or the listener exists
+    pids = start_workers(args.workers) if args.workers > 1 else []
+    # turn a terminate into an exit so the workers are taken down too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_heartbeats()
+
+    server = Server(('0.0.0.0', 9999), Handler)
+    for link in worker_links:
+        t = threading.Thread(target=file_tickets, args=(link,))
+        t.daemon = True
+        t.start()
+    try:
+        server.serve_forever()
+        if pids:
+            sys.exit("A worker exited")
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
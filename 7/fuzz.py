@@ -0,0 +1,66 @@
+import random
+import sys
+
+import server
+
+# The packet codec as it was before unescape_split and fmt_args were
+# rewritten, one byte at a time. The rewrites must give the same results
+
+def old_unescape_split(data):
+    esc = False
+    cur = b''
+    fields = []
+    for c in data:
+        if c == b'\\'[0]:
+            if esc:
+                cur += b'\\'
+                esc = False
+            else:
+                esc = True
+            continue
+        if esc:
+            cur += bytes([c])
+            esc = False
+            continue
+        if c == b'/'[0]:
+            fields.append(cur)
+            cur = b''
+        else:
+            cur += bytes([c])
+    fields.append(cur)
+    return fields
+
+def old_fmt_args(m_type, *args):
+    data = b'/' + m_type.encode('ascii') + b'/'
+    for a in args:
+        if type(a) == int:
+            if a >= 2147483648:
+                return None
+            a = str(a)
+        if type(a) == str:
+            a = a.encode('ascii')
+        a = a.replace(b'\\', b'\\\\').replace(b'/', b'\\/')
+        data += a + b'/'
+    return data
+
+# mostly the bytes the codec cares about, so escapes and separators pile up
+ALPHABET = b'ab/\\\n0'
+
+def random_bytes(rnd, max_len):
+    return bytes(rnd.choice(ALPHABET) for _ in range(rnd.randrange(max_len)))
+
+def random_arg(rnd, data):
+    return rnd.choice([rnd.randrange(2147483648), rnd.randrange(2147483648, 2 ** 32), data.decode('ascii'), data])
+
+seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+rnd = random.Random(seed)
+
+for i in range(count):
+    data = random_bytes(rnd, 40)
+    assert server.unescape_split(data) == old_unescape_split(data), data
+    args = [random_arg(rnd, random_bytes(rnd, 20)) for _ in range(rnd.randrange(4))]
+    m_type = rnd.choice(['data', 'ack', 'close'])
+    assert server.fmt_args(m_type, *args) == old_fmt_args(m_type, *args), (m_type, args)
+
+print("%d inputs match" % count)
@@ -1,7 +1,23 @@
+import argparse
+from collections import deque
+import heapq
+import itertools
+import os
 import socket
 import selectors
 import select
+import signal
+import struct
+import sys
 import time
+import zlib
+
+# per packet logging, enabled with --debug
+debug = False
+
+def log(*args):
+    if debug:
+        print(*args)
 
 def short(d):
     s = str(d)
@@ -9,28 +25,132 @@ def short(d):
         return s[:100] + " ... " + s[-100:]
     return s
 
-class LineReversal:
+class SendBuffer:
+
+    # appends are packed into chunks of this size
+    CHUNK_SIZE = 65536
 
     def __init__(self):
-        pass
+        self.chunks = deque()
+        # bytes of chunks[0] already consumed
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        self.size += len(data)
+        if self.chunks and len(self.chunks[-1]) < self.CHUNK_SIZE:
+            self.chunks[-1] += data
+        else:
+            self.chunks.append(bytearray(data))
 
-    def poll(self):
-        for s in sessions.values():
-            nl = s.recv_buf.find(b'\n')
-            if nl == -1:
+    def consume(self, n):
+        self.size -= n
+        n += self.head
+        while n and n >= len(self.chunks[0]):
+            n -= len(self.chunks.popleft())
+        self.head = n
+
+    def slice(self, offset, length):
+        pieces = []
+        offset += self.head
+        for chunk in self.chunks:
+            if offset >= len(chunk):
+                offset -= len(chunk)
                 continue
-            spl = s.recv_buf.split(b'\n')
-            s.recv_buf = spl.pop()
-            for line in spl:
-                l = list(line)
-                l.reverse()
-                rev = bytes(l)
-                s.send_data(rev + b'\n')
+            with memoryview(chunk) as view:
+                piece = view[offset:offset + length]
+                pieces.append(piece)
+                length -= len(piece)
+                offset = 0
+                if not length:
+                    break
+        data = b''.join(pieces)
+        for piece in pieces:
+            piece.release()
+        return data
+
+class RecvBuffer:
+
+    def __init__(self):
+        self.buf = bytearray()
+        # start of the first incomplete line
+        self.start = 0
+        # no newline in buf[start:scanned]
+        self.scanned = 0
+
+    def extend(self, data):
+        self.buf += data
+
+    def lines(self):
+        nl = self.buf.rfind(b'\n', self.scanned)
+        if nl == -1:
+            self.scanned = len(self.buf)
+            return []
+        with memoryview(self.buf) as view:
+            block = bytes(view[self.start:nl])
+        self.start = self.scanned = nl + 1
+        # drop consumed lines once they are most of the buffer
+        if self.start > len(self.buf) // 2:
+            del self.buf[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+        return block.split(b'\n')
+
+class LineReversal:
+
+    def on_lines(self, session, lines):
+        session.send_data(b''.join([line[::-1] + b'\n' for line in lines]))
 
+# app.on_lines(session, lines) is called as soon as a session has received
+# one or more complete lines, without their newlines. It replies with
+# session.send_data
 app = LineReversal()
 
 sessions = {}
 
+class Outbox:
+
+    def __init__(self):
+        # key -> (sock, addr, data). Acks are keyed by session so a newer
+        # one replaces any still queued, everything else gets its own key
+        self.packets = {}
+        self.seq = itertools.count()
+
+    def put(self, sock, addr, data, key=None):
+        if key is None:
+            key = next(self.seq)
+        self.packets[key] = (sock, addr, data)
+
+    def flush(self):
+        for sock, addr, data in self.packets.values():
+            if debug:
+                print(">>>", short(data))
+            try:
+                sock.sendto(data, addr)
+            except BlockingIOError:
+                # dropped like any other lost datagram
+                pass
+        self.packets.clear()
+
+outbox = Outbox()
+
+# heap of (deadline, seq, session). Entries are not removed when a
+# session's deadline moves, they are skipped when popped instead
+timers = []
+timer_seq = itertools.count()
+
+def schedule(session, deadline):
+    session.deadline = deadline
+    heapq.heappush(timers, (deadline, next(timer_seq), session))
+
+def next_timeout(t):
+    if not timers:
+        return 1
+    return min(1, max(0, timers[0][0] - t))
+
 def valid_int(s):
     try:
         val = int(s.decode('ascii'))
@@ -43,7 +163,7 @@ def valid_int(s):
         return None
 
 def fmt_args(m_type, *args):
-    data = b'/' + m_type.encode('ascii') + b'/'
+    pieces = [b'', m_type.encode('ascii')]
     for a in args:
         if type(a) == int:
             if a >= 2147483648:
@@ -51,44 +171,65 @@ def fmt_args(m_type, *args):
             a = str(a)
         if type(a) == str:
             a = a.encode('ascii')
-        a = a.replace(b'\\', b'\\\\').replace(b'/', b'\\/')
-        data += a + b'/'
-    return data
+        pieces.append(a.replace(b'\\', b'\\\\').replace(b'/', b'\\/'))
+    pieces.append(b'')
+    return b'/'.join(pieces)
 
 def tick():
     t = time.time()
-    for session in list(sessions.values()):
+    while timers and timers[0][0] <= t:
+        deadline, _, session = heapq.heappop(timers)
+        if session.closed or session.deadline != deadline:
+            continue
         if session.is_expired(t):
             session.close()
             continue
-        if session.needs_retry(t):
-            session.retry()
-    app.poll()
+        session.retry(t)
 
 class Session:
 
+    # initial retransmit timeout, before any round trip is measured
     RETRY_TIMEOUT = 1
+    MIN_RTO = 0.05
+    MAX_RTO = 3
     EXPIRE_TIMEOUT = 60
+    # payload bytes per data packet, and how many may be unacked at once
+    SEGMENT_SIZE = 950
+    WINDOW = 16
 
-    def __init__(self, sess_id, sock, addr):
+    def __init__(self, sess_id, sock, addr, app):
         self.id = sess_id
+        self.app = app
         self.sock = sock
         self.addr = addr
         self.closed = False
         self.recv_len = 0
-        self.recv_buf = b''
+        self.recv_buf = RecvBuffer()
         # amount of acknowledged data
         self.send_ack_len = 0
         # Total size we have buffered to send
         self.send_len = 0
-        self.send_buf = b''
+        # everything after send_ack_len, sent or not
+        self.send_buf = SendBuffer()
+        # end of the data sent so far
+        self.send_next = 0
+        # unacked segments, oldest first: [start, end, sent_at, retransmitted]
+        self.in_flight = deque()
+        self.dup_acks = 0
+        # Smoothed round trip estimate, as in RFC 6298
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.RETRY_TIMEOUT
         # Timeout counter
         self.ack_timer = None
+        # When the timer heap should next look at this session
+        self.deadline = None
 
     def close(self):
         self.send('close', self.id)
         del sessions[self.id]
         self.closed = True
+        self.deadline = None
 
     def update_last_ack(self):
         # Caught up, clear timer
@@ -108,16 +249,28 @@ class Session:
             return False
         return t - self.ack_timer > self.EXPIRE_TIMEOUT
 
-    def needs_retry(self, t):
-        if self.ack_timer is None:
-            return False
-        return t - self.ack_timer > self.RETRY_TIMEOUT
+    def arm_timer(self):
+        if not self.in_flight:
+            self.deadline = None
+            return
+        deadline = self.in_flight[0][2] + self.rto
+        if deadline != self.deadline:
+            schedule(self, deadline)
+
+    def on_rtt_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
 
     def send(self, m_type, *args):
         data = fmt_args(m_type, *args)
         if data is not None:
-            print(">>>", short(data))
-            self.sock.sendto(data, self.addr)
+            key = ('ack', self.addr, self.id) if m_type == 'ack' else None
+            outbox.put(self.sock, self.addr, data, key)
 
     def on_data(self, data, pos):
         if pos > self.recv_len:
@@ -130,152 +283,320 @@ class Session:
         new_data = data[overlap:]
         self.recv_len += len(new_data)
         if len(new_data):
-            self.recv_buf += new_data
+            self.recv_buf.extend(new_data)
+            if b'\n' in new_data:
+                self.app.on_lines(self, self.recv_buf.lines())
         self.send('ack', self.id, self.recv_len)
 
     def on_ack(self, l):
         # ack for previous data
-        if l <= self.send_ack_len:
-            print("Ignoring ack (prev data)")
+        if l < self.send_ack_len:
+            log("Ignoring ack (prev data)")
+            return
+        if l == self.send_ack_len:
+            # The peer got something past a gap. After a few of these, resend
+            # the segment it is missing rather than waiting for the timer
+            if self.in_flight:
+                self.dup_acks += 1
+                if self.dup_acks == 3:
+                    self.retransmit(self.in_flight[0], time.time())
+                    # the head's clock restarted, so must the timer
+                    self.arm_timer()
             return
         # unexpected ack
         if l > self.send_len:
             self.close()
             return
+        t = time.time()
         # length of data confirmed by ack
         conf = l - self.send_ack_len
-        self.send_buf = self.send_buf[conf:]
+        self.send_buf.consume(conf)
         self.send_ack_len = l
+        self.send_next = max(self.send_next, l)
+        self.dup_acks = 0
+        rtt = None
+        while self.in_flight and self.in_flight[0][1] <= l:
+            start, end, sent_at, retransmitted = self.in_flight.popleft()
+            # Karn: a retransmitted segment gives an ambiguous sample
+            if not retransmitted:
+                rtt = t - sent_at
+        if self.in_flight and self.in_flight[0][0] < l:
+            self.in_flight[0][0] = l
+        if rtt is not None:
+            self.on_rtt_sample(rtt)
         self.update_last_ack()
-        # not all the data was confirmed, send the rest again
-        if l < self.send_len:
-            self.retry()
+        self.fill_window()
+        self.arm_timer()
+
+    def transmit(self, start, end):
+        offset = start - self.send_ack_len
+        self.send('data', self.id, start, self.send_buf.slice(offset, end - start))
+
+    def retransmit(self, segment, t):
+        self.transmit(segment[0], segment[1])
+        segment[2] = t
+        segment[3] = True
+
+    def retry(self, t):
+        # retransmit timeout: resend what is still unacked and back off
+        for segment in self.in_flight:
+            self.retransmit(segment, t)
+        self.rto = min(self.rto * 2, self.MAX_RTO)
+        self.arm_timer()
 
-    def retry(self):
-        trunc = self.send_buf[:950]
-        self.send('data', self.id, self.send_ack_len, trunc)
+    def fill_window(self):
+        t = time.time()
+        while len(self.in_flight) < self.WINDOW and self.send_next < self.send_len:
+            start = self.send_next
+            end = min(start + self.SEGMENT_SIZE, self.send_len)
+            self.transmit(start, end)
+            self.in_flight.append([start, end, t, False])
+            self.send_next = end
 
     def send_data(self, data):
-        self.send_buf += data
-        trunc = self.send_buf[:950]
-        self.update_last_send()
-        self.send('data', self.id, self.send_ack_len, trunc)
+        self.send_buf.append(data)
         self.send_len += len(data)
+        self.update_last_send()
+        self.fill_window()
+        self.arm_timer()
 
 def unescape_split(data):
-    esc = False
-    cur = b''
-    fields = []
-    for c in data:
-        if c == b'\\'[0]:
-            if esc:
-                cur += b'\\'
-                esc = False
-            else:
-                esc = True
+    if b'\\' not in data:
+        return data.split(b'/')
+    # Each part after the first follows a backslash. Unless that backslash
+    # was itself escaped, it escapes the first byte of the part
+    parts = data.split(b'\\')
+    fields = parts[0].split(b'/')
+    cur = [fields.pop()]
+    escaped = False
+    for part in parts[1:]:
+        if escaped:
+            cur.append(b'\\')
+            escaped = False
+            rest = part
+        elif not part:
+            # escaping the next backslash, or a trailing lone backslash
+            escaped = True
             continue
-        if esc:
-            cur += bytes([c])
-            esc = False
-            continue
-        if c == b'/'[0]:
-            fields.append(cur)
-            cur = b''
         else:
-            cur += bytes([c])
-    fields.append(cur)
+            cur.append(part[:1])
+            rest = part[1:]
+        spl = rest.split(b'/')
+        cur.append(spl[0])
+        if len(spl) > 1:
+            fields.append(b''.join(cur))
+            fields.extend(spl[1:-1])
+            cur = [spl[-1]]
+    fields.append(b''.join(cur))
     return fields
 
 def recv_packet(sock, data, address):
     if len(data) < 3 or len(data) >= 1000:
-        print("Drop invalid (len)", data)
+        log("Drop invalid (len)", data)
         return
     if data[0] != b'/'[0] or data[-1] != b'/'[0]:
-        print("Drop invalid (slash)", data)
+        log("Drop invalid (slash)", data)
         return
     fields = unescape_split(data)
     m_type = fields[1]
     fields = fields[2:-1]
-    print("<<<", m_type, short(fields))
+    if debug:
+        print("<<<", m_type, short(fields))
     if m_type == b'connect':
         if len(fields) != 1:
-            print("Drop invalid (connect len)", data)
+            log("Drop invalid (connect len)", data)
             return
         session = valid_int(fields[0])
         if session is None:
-            print("Drop invalid (connect session)", data)
+            log("Drop invalid (connect session)", data)
             return
         if session not in sessions:
-            s = sessions[session] = Session(session, sock, address)
+            s = sessions[session] = Session(session, sock, address, app)
         sessions[session].send('ack', session, 0)
     elif m_type == b'data':
         if len(fields) != 3:
-            print("Drop invalid (data len)", data)
+            log("Drop invalid (data len)", data)
             return
         session = valid_int(fields[0])
         if session is None:
-            print("Drop invalid (data session)", data)
+            log("Drop invalid (data session)", data)
             return
         pos = valid_int(fields[1])
         if pos is None:
-            print("Drop invalid (data pos int)", data)
+            log("Drop invalid (data pos int)", data)
             return
         msg_data = fields[2]
         if session not in sessions:
-            print("Drop invalid (data no session)", data)
+            log("Drop invalid (data no session)", data)
             data = fmt_args('close', session)
             if data is not None:
-                print(">>>", data)
-                sock.sendto(data, address)
+                outbox.put(sock, address, data)
             return
         sessions[session].on_data(msg_data, pos)
     elif m_type == b'ack':
         if len(fields) != 2:
-            print("Drop invalid (ack len)", data)
+            log("Drop invalid (ack len)", data)
             return
         session = valid_int(fields[0])
         if session is None:
-            print("Drop invalid (ack session int)", data)
+            log("Drop invalid (ack session int)", data)
             return
         a_len = valid_int(fields[1])
         if a_len is None:
-            print("Drop invalid (ack len int)", data)
+            log("Drop invalid (ack len int)", data)
             return
         if session not in sessions:
-            print("Drop invalid (ack no session)", data)
+            log("Drop invalid (ack no session)", data)
             data = fmt_args('close', session)
             if data is not None:
-                print(">>>", data)
-                sock.sendto(data, address)
+                outbox.put(sock, address, data)
             return
         sessions[session].on_ack(a_len)
     elif m_type == b'close':
         if len(fields) != 1:
-            print("Drop invalid (close len)", data)
+            log("Drop invalid (close len)", data)
             return
         session = valid_int(fields[0])
         if session is None:
-            print("Drop invalid (close session int)", data)
+            log("Drop invalid (close session int)", data)
             return
         if session not in sessions:
-            print("Drop invalid (close no session)", data)
+            log("Drop invalid (close no session)", data)
             return
         sessions[session].close()
     else:
-        print("Drop invalid (type)", data)
+        log("Drop invalid (type)", data)
 
 
-if __name__ == '__main__':
+# most datagrams to take per wakeup before running timers
+MAX_BATCH = 1024
+
+def drain(sock, buf, handle):
+    view = memoryview(buf)
+    for _ in range(MAX_BATCH):
+        try:
+            size, address = sock.recvfrom_into(buf)
+        except BlockingIOError:
+            break
+        handle(sock, bytes(view[:size]), address)
+
+def packet_session(data):
+    # The session id comes before any payload, so a cheap split finds it
+    # unless something in front of it is escaped
+    head = data.split(b'/', 3)
+    if len(head) < 4 or b'\\' in head[1] or b'\\' in head[2]:
+        head = unescape_split(data)
+        if len(head) < 4:
+            return None
+    return valid_int(head[2])
+
+class Router:
+
+    # Workers share the port through SO_REUSEPORT, which balances by
+    # address. A session belongs to the worker picked by hashing its
+    # address and id, and datagrams that land elsewhere are passed on
+    # to the owner over a unix socket, prefixed with the address
+
+    def __init__(self, index, inboxes):
+        self.index = index
+        # write ends of each worker's inbox
+        self.inboxes = inboxes
+
+    def owner(self, address, session):
+        key = b'%s:%d:%d' % (address[0].encode('ascii'), address[1], session)
+        return zlib.crc32(key) % len(self.inboxes)
+
+    def recv(self, sock, data, address):
+        session = packet_session(data)
+        # anything without a valid session is dropped wherever it lands
+        owner = self.index if session is None else self.owner(address, session)
+        if owner == self.index:
+            recv_packet(sock, data, address)
+            return
+        header = socket.inet_aton(address[0]) + struct.pack('!H', address[1])
+        try:
+            self.inboxes[owner].send(header + data)
+        except BlockingIOError:
+            pass
+
+    def recv_forwarded(self, inbox, sock):
+        for _ in range(MAX_BATCH):
+            try:
+                msg = inbox.recv(8192 + 6)
+            except BlockingIOError:
+                break
+            (port,) = struct.unpack('!H', msg[4:6])
+            recv_packet(sock, msg[6:], (socket.inet_ntoa(msg[:4]), port))
+
+def serve(router=None, inbox=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if router is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind(('0.0.0.0', 9999))
+    sock.setblocking(False)
+    buf = bytearray(8192)
+    handle = recv_packet if router is None else router.recv
     selector = selectors.EpollSelector()
     selector.register(sock, selectors.EVENT_READ)
+    if inbox is not None:
+        selector.register(inbox, selectors.EVENT_READ)
     try:
         while True:
-            ready = selector.select(timeout=1)
-            if len(ready):
-                data, address = sock.recvfrom(8192)
-                recv_packet(sock, data, address)
+            ready = selector.select(timeout=next_timeout(time.time()))
+            for key, _ in ready:
+                if key.fileobj is sock:
+                    drain(sock, buf, handle)
+                else:
+                    router.recv_forwarded(inbox, sock)
             tick()
+            outbox.flush()
     finally:
         sock.close()
+
+def serve_workers(count):
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+    for inbox, writer in pairs:
+        inbox.setblocking(False)
+        writer.setblocking(False)
+    inboxes = [writer for _, writer in pairs]
+    children = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # keep this worker's inbox and the other workers' writers
+                for other, (inbox, writer) in enumerate(pairs):
+                    if other != index:
+                        inbox.close()
+                pairs[index][1].close()
+                serve(Router(index, inboxes), pairs[index][0])
+            finally:
+                os._exit(1)
+        children.append(pid)
+    for inbox, writer in pairs:
+        inbox.close()
+        writer.close()
+    # turn a terminate into an exit so the workers are taken down too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # the others would keep handing the sessions of a dead worker to
+        # its inbox, so one exiting takes them all down
+        pid, status = os.wait()
+        sys.exit("Worker %d exited" % pid)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, 15)
+            except ProcessLookupError:
+                pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    debug = args.debug
+    if args.workers > 1:
+        serve_workers(args.workers)
+    else:
+        serve()
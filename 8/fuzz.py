@@ -0,0 +1,79 @@
+import random
+import sys
+
+import server
+
+# The cipher ops one byte at a time, as the server applied them before
+# they were compiled into tables. Compiled ciphers must give the same bytes
+
+def reverse_bits(v, pos):
+    return int('{:08b}'.format(v)[::-1], 2)
+
+def encode_op(op):
+    code = op[0]
+    if code == 1:
+        return reverse_bits
+    elif code == 2:
+        return lambda v, pos: v ^ op[1]
+    elif code == 3:
+        return lambda v, pos: v ^ (pos & 0xFF)
+    elif code == 4:
+        return lambda v, pos: (v + op[1]) & 0xFF
+    else:
+        return lambda v, pos: (v + pos) & 0xFF
+
+def decode_op(op):
+    code = op[0]
+    if code == 4:
+        return lambda v, pos: (v - op[1]) & 0xFF
+    elif code == 5:
+        return lambda v, pos: (v - pos) & 0xFF
+    return encode_op(op)
+
+def run(funcs, msg, pos):
+    msg = bytearray(msg)
+    for func in funcs:
+        for i in range(len(msg)):
+            msg[i] = func(msg[i], pos + i)
+    return bytes(msg)
+
+def random_spec(rnd):
+    spec = []
+    for _ in range(rnd.randrange(7)):
+        code = rnd.randrange(1, 6)
+        if code in (2, 4):
+            # zero and repeated operands, so normalize_spec has work to do
+            spec.append((code, rnd.choice([0, 1, 255, rnd.randrange(256)])))
+        else:
+            spec.append((code,))
+        if rnd.random() < .3:
+            spec.append(spec[-1])
+    return spec
+
+# around the per-byte, slice and numpy cut-overs in apply
+SIZES = [0, 1, server.NUMPY_THRESHOLD - 1, server.NUMPY_THRESHOLD,
+         server.SLICE_THRESHOLD - 1, server.SLICE_THRESHOLD, 3000]
+
+seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+rnd = random.Random(seed)
+
+for i in range(count):
+    spec = random_spec(rnd)
+    encoders = [encode_op(op) for op in spec]
+    decoders = [decode_op(op) for op in reversed(spec)]
+    cipher = server.Cipher.bake(spec)
+    size = rnd.choice(SIZES)
+    msg = bytes(rnd.getrandbits(8) for _ in range(size))
+    pos = rnd.randrange(1 << 20)
+    encoded = run(encoders, msg, pos)
+    if cipher is None:
+        assert encoded == msg and run(encoders, bytes(range(256)), pos) == bytes(range(256)), spec
+        continue
+    assert cipher.encode(msg, pos) == encoded, spec
+    assert cipher.decode(msg, pos) == run(decoders, msg, pos), spec
+    # without numpy, whether or not it is installed
+    assert server.apply(cipher.encode_tables, msg, pos) == encoded, spec
+    assert server.apply(cipher.decode_tables, encoded, pos) == msg, spec
+
+print("%d specs match%s" % (count, "" if server.numpy else " (numpy not installed)"))
@@ -1,203 +1,307 @@
+import asyncio
 from collections import namedtuple
-import random
-import socketserver
+import functools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 Function = namedtuple('Function', 'encode decode')
 
 class ProtocolError(Exception):
     pass
 
-def reverse(symmetric=False, decode=None):
-    assert (symmetric and decode is None) or (not symmetric and decode)
-    def decorator(func):
-        if symmetric:
-            return Function(encode=func, decode=func)
-        return Function(encode=func, decode=decode)
-    return decorator
+IDENTITY = bytes(range(256))
+
+def table(func):
+    return bytes(func(v) & 0xFF for v in range(256))
+
+# Ops that depend on the stream position get one table per position
+# modulo 256, as a tuple. Position independent ops are a single table
+def pos_tables(func):
+    return tuple(table(lambda v: func(v, pos)) for pos in range(256))
+
+def compose(first, then):
+    # tables applying `first` then `then`
+    if type(first) is bytes and type(then) is bytes:
+        return first.translate(then)
+    if type(first) is bytes:
+        first = (first,) * 256
+    if type(then) is bytes:
+        then = (then,) * 256
+    return tuple(a.translate(b) for a, b in zip(first, then))
+
+# below this, looking up each byte beats a slice per residue
+SLICE_THRESHOLD = 1024
+# from this size numpy, when installed, beats both
+NUMPY_THRESHOLD = 128
+
+def numpy_lut(tables):
+    # positional tables flattened so residue * 256 + byte indexes them
+    if numpy is None or type(tables) is bytes:
+        return None
+    return numpy.frombuffer(b''.join(tables), dtype=numpy.uint8)
+
+def apply_numpy(lut, msg, pos):
+    data = numpy.frombuffer(msg, dtype=numpy.uint8)
+    index = (numpy.arange(pos, pos + len(data), dtype=numpy.intp) & 0xFF) << 8
+    index |= data
+    return lut.take(index).tobytes()
+
+def apply(tables, msg, pos, lut=None):
+    if type(tables) is bytes:
+        return bytes(msg).translate(tables)
+    if lut is not None and len(msg) >= NUMPY_THRESHOLD:
+        return apply_numpy(lut, msg, pos)
+    if len(msg) < SLICE_THRESHOLD:
+        return bytes([tables[(pos + i) & 0xFF][c] for i, c in enumerate(msg)])
+    # bytes 256 apart share a position residue, so each residue is one
+    # C-level slice and translate
+    out = bytearray(len(msg))
+    for i in range(min(256, len(msg))):
+        out[i::256] = msg[i::256].translate(tables[(pos + i) & 0xFF])
+    return bytes(out)
+
+REVERSE_BITS = table(lambda v: int('{:08b}'.format(v)[::-1], 2))
+XOR_POS = pos_tables(lambda v, pos: v ^ pos)
 
 class OP:
 
-    @staticmethod
-    @reverse(symmetric=True)
-    def reversebits(msg, pos):
-        for i in range(len(msg)):
-            v = msg[i]
-            new = (v & 1) << 7
-            v >>= 1
-            new |= (v & 1) << 6
-            v >>= 1
-            new |= (v & 1) << 5
-            v >>= 1
-            new |= (v & 1) << 4
-            v >>= 1
-            new |= (v & 1) << 3
-            v >>= 1
-            new |= (v & 1) << 2
-            v >>= 1
-            new |= (v & 1) << 1
-            v >>= 1
-            new |= v
-            msg[i] = new
+    reversebits = Function(encode=REVERSE_BITS, decode=REVERSE_BITS)
 
     @staticmethod
     def xor_factory(xor):
         if xor == 0:
             return None # no-op
-        def func(msg, pos):
-            for i in range(len(msg)):
-                msg[i] ^= xor
-        return Function(encode=func, decode=func)
+        t = table(lambda v: v ^ xor)
+        return Function(encode=t, decode=t)
 
-    @staticmethod
-    @reverse(symmetric=True)
-    def xorpos(msg, pos):
-        for i in range(len(msg)):
-            stream_pos = i + pos
-            msg[i] ^= stream_pos & 0xFF
+    xorpos = Function(encode=XOR_POS, decode=XOR_POS)
 
     @staticmethod
     def add_factory(add):
         if add == 0:
             return None # no-op
-        def encode(msg, pos):
-            for i in range(len(msg)):
-                msg[i] = (msg[i] + add) & 0xFF
-        def decode(msg, pos):
-            for i in range(len(msg)):
-                msg[i] = (msg[i] - add) & 0xFF
-        return Function(encode=encode, decode=decode)
-
-    def decode_addpos(msg, pos):
-        for i in range(len(msg)):
-            stream_pos = i + pos
-            msg[i] = (msg[i] - stream_pos) & 0xFF
+        return Function(encode=table(lambda v: v + add), decode=table(lambda v: v - add))
+
+    addpos = Function(encode=pos_tables(lambda v, pos: v + pos),
+                      decode=pos_tables(lambda v, pos: v - pos))
 
     @staticmethod
-    @reverse(decode=decode_addpos)
-    def addpos(msg, pos):
-        for i in range(len(msg)):
-            stream_pos = i + pos
-            msg[i] = (msg[i] + stream_pos) & 0xFF
+    def from_spec(op):
+        code = op[0]
+        if code == 1:
+            return OP.reversebits
+        elif code == 2:
+            return OP.xor_factory(op[1])
+        elif code == 3:
+            return OP.xorpos
+        elif code == 4:
+            return OP.add_factory(op[1])
+        else:
+            return OP.addpos
+
+def is_identity(tables):
+    if type(tables) is bytes:
+        return tables == IDENTITY
+    return all(t == IDENTITY for t in tables)
+
+# Spec entries are (opcode,) or (opcode, operand). Adjacent xors and adds
+# merge, self-inverse pairs cancel and zero operands drop out, so
+# equivalent specs share a cache entry
+def normalize_spec(spec):
+    out = []
+    for op in spec:
+        if out and out[-1][0] == op[0]:
+            code = op[0]
+            if code in (1, 3):
+                out.pop()
+                continue
+            elif code == 2:
+                op = (2, out.pop()[1] ^ op[1])
+            elif code == 4:
+                op = (4, (out.pop()[1] + op[1]) & 0xFF)
+        if op in ((2, 0), (4, 0)):
+            continue
+        out.append(op)
+    return tuple(out)
 
 class Cipher:
 
     @staticmethod
-    def bake(operations):
-        operations = list(filter(lambda op: op is not None, operations))
-        if not operations:
-            return None
-        encode = tuple(op.encode for op in operations)
-        decode = [op.decode for op in operations]
-        decode.reverse()
-        cipher = Cipher(encode, tuple(decode))
-        # very dirty and lazy, just generate random input, if encoding
-        # returns the same data then this is a no-op
-        randmsg = bytes(random.getrandbits(8) for _ in range(200))
-        if cipher.encode(randmsg, 0) == randmsg:
+    def bake(spec):
+        return Cipher.compile(normalize_spec(spec))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def compile(spec):
+        operations = [OP.from_spec(op) for op in spec]
+        # fold the whole chain into one set of tables each way
+        encode = decode = IDENTITY
+        for op in operations:
+            encode = compose(encode, op.encode)
+        for op in reversed(operations):
+            decode = compose(decode, op.decode)
+        # the tables cover every byte at every position residue, so this
+        # is exact
+        if is_identity(encode):
             return None
-        return cipher
+        return Cipher(encode, decode)
 
     def __init__(self, encode, decode):
-        self.encode_ops = encode
-        self.decode_ops = decode
+        self.encode_tables = encode
+        self.decode_tables = decode
+        self.encode_lut = numpy_lut(encode)
+        self.decode_lut = numpy_lut(decode)
 
     def encode(self, msg, pos):
-        msg = bytearray(msg)
-        for op in self.encode_ops:
-            op(msg, pos)
-        return bytes(msg)
+        return apply(self.encode_tables, msg, pos, self.encode_lut)
 
     def decode(self, msg, pos):
-        msg = bytearray(msg)
-        for op in self.decode_ops:
-            op(msg, pos)
-        return bytes(msg)
+        return apply(self.decode_tables, msg, pos, self.decode_lut)
 
-class Handler(socketserver.BaseRequestHandler):
+class ToyParser:
 
-    def handle(self):
-        try:
-            self.cipher = self.read_spec()
-        except ProtocolError:
-            print("ProtocolError")
-            self.request.close()
-            return
-        if self.cipher is None:
-            print("Bad cipher")
-            self.request.close()
+    # Picks the most wanted toy of each line as decoded input arrives,
+    # holding on to at most one incomplete item between feeds
+
+    def __init__(self):
+        self.item = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.max_qty = 0
+        self.max_toy = None
+        # only whitespace seen on this line so far
+        self.blank = True
+
+    def consider(self, items):
+        if not items:
             return
+        qtys = [int(item[:item.index(b'x')]) for item in items]
+        qty = max(qtys)
+        # the first item wins a tie, as it did before
+        if qty > self.max_qty:
+            item = items[qtys.index(qty)]
+            self.max_qty = qty
+            self.max_toy = item[item.index(b'x') + 2:].decode('ascii')
+
+    def feed(self, data):
+        # yields (qty, toy) for each line that data completes
+        start = 0
+        while True:
+            nl = data.find(b'\n', start)
+            segment = data[start:] if nl == -1 else data[start:nl]
+            if self.blank and segment and not segment.isspace():
+                self.blank = False
+            items = segment.split(b',')
+            if self.item:
+                items[0] = bytes(self.item) + items[0]
+                self.item.clear()
+            if nl == -1:
+                self.item += items.pop()
+                self.consider(items)
+                return
+            if self.blank:
+                raise ProtocolError()
+            items[-1] = items[-1].rstrip()
+            self.consider(items)
+            yield self.max_qty, self.max_toy
+            self.reset()
+            start = nl + 1
 
+def parse_spec(buf):
+    # returns the spec and where it ends in buf, or None until the
+    # terminating zero has arrived
+    spec = []
+    i = 0
+    while i < len(buf):
+        op = buf[i]
+        if op == 0:
+            return spec, i + 1
+        elif op in (1, 3, 5):
+            spec.append((op,))
+            i += 1
+        elif op in (2, 4):
+            if i + 1 >= len(buf):
+                return None
+            spec.append((op, buf[i + 1]))
+            i += 2
+        else:
+            raise ProtocolError()
+    return None
+
+class Connection(asyncio.Protocol):
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.spec_buf = bytearray()
+        self.cipher = None
         self.in_pos = 0
         self.out_pos = 0
+        self.parser = ToyParser()
 
+    def data_received(self, data):
+        if self.cipher is None:
+            data = self.read_spec(data)
+            if not data:
+                return
+        data = self.cipher.decode(data, self.in_pos)
+        self.in_pos += len(data)
+        # every reply completed by this chunk goes out in one write
+        replies = []
         try:
-
-            while True:
-                max_qty = 0
-                max_toy = None
-                line = self.read_line().decode('ascii').strip()
-                if not line:
-                    raise ProtocolError()
-                print("Recv", line)
-                requests = line.split(',')
-                for req in requests:
-                    idx = req.index('x')
-                    qty = int(req[:idx])
-                    toy = req[idx + 2:]
-                    if qty > max_qty:
-                        max_qty = qty
-                        max_toy = toy
+            for max_qty, max_toy in self.parser.feed(data):
                 print("Send", (max_qty, max_toy))
-                self.write('%dx %s\n' % (max_qty, max_toy))
-
+                replies.append('%dx %s\n' % (max_qty, max_toy))
         except ProtocolError:
-            pass
-
-        self.request.close()
+            self.write(''.join(replies))
+            self.transport.close()
+            return
+        self.write(''.join(replies))
 
-    def read_line(self):
-        data = b''
-        while True:
-            enc = self.request.recv(1)
-            if not enc:
-                raise ProtocolError()
-            val = self.cipher.decode(enc, self.in_pos)
-            data += val
-            self.in_pos += 1
-            if val == b'\n':
-                break
+    def read_spec(self, data):
+        # returns input left over after the spec
+        self.spec_buf += data
+        try:
+            parsed = parse_spec(self.spec_buf)
+        except ProtocolError:
+            print("ProtocolError")
+            self.transport.close()
+            return None
+        if parsed is None:
+            return None
+        spec, end = parsed
+        self.cipher = Cipher.bake(spec)
+        if self.cipher is None:
+            print("Bad cipher")
+            self.transport.close()
+            return None
+        data = bytes(self.spec_buf[end:])
+        self.spec_buf = None
         return data
 
     def write(self, text):
+        if not text:
+            return
         msg = text.encode('ascii')
-        self.request.sendall(self.cipher.encode(msg, self.out_pos))
+        self.transport.write(self.cipher.encode(msg, self.out_pos))
         self.out_pos += len(msg)
 
-    def read_spec(self):
-        operations = []
-        while True:
-            op = self.request.recv(1)[0]
-            if op == 0:
-                break
-            elif op == 1:
-                operations.append(OP.reversebits)
-            elif op == 2:
-                operand = self.request.recv(1)[0]
-                operations.append(OP.xor_factory(operand))
-            elif op == 3:
-                operations.append(OP.xorpos)
-            elif op == 4:
-                operand = self.request.recv(1)[0]
-                operations.append(OP.add_factory(operand))
-            elif op == 5:
-                operations.append(OP.addpos)
-            else:
-                raise ProtocolError()
-        return Cipher.bake(operations)
-        
+    # stop reading from a client that is not reading its replies
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
 
-class Server(socketserver.ThreadingTCPServer):
-    allow_reuse_address = True
+async def main():
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(Connection, '0.0.0.0', 9999,
+                                      reuse_address=True, backlog=4096)
+    async with server:
+        await server.serve_forever()
 
-server = Server(('0.0.0.0', 9999), Handler)
-server.serve_forever()
+if __name__ == '__main__':
+    asyncio.run(main())
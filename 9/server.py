@@ -1,118 +1,592 @@
+import argparse
+import bisect
+import gc
 import json
-from queue import PriorityQueue, Empty
+import heapq
+import os
+import pickle
+import re
+import signal
 import socket
 import selectors
-from collections import namedtuple, defaultdict
+import struct
+import sys
+import time
+import traceback
+import zlib
+from collections import namedtuple, OrderedDict, deque
+from functools import partial
+from operator import itemgetter
 
-Client = namedtuple('Client', 'sock line_buf working_on waits')
-Wait = namedtuple('Wait', 'client_id queues')
+Client = namedtuple('Client', 'sock line_buf working_on waits out backlog held')
+
+class Wait:
+
+    # A blocked get, queued on every queue it names. Serving or cancelling
+    # it only clears `active`; the other queues drop it when they reach it.
+
+    def __init__(self, client_id, queues):
+        self.client_id = client_id
+        self.queues = queues
+        self.active = True
 
 clients = {}
-valid_jobs = set()
+# fds of clients with unsent output
+pending = set()
+# job id -> Queue currently holding it
+jobs = {}
 assigned = {}
 
 job_counter = 0
+# a shard hands out the ids congruent to its index, stepping by the shard count
+id_step = 1
+
+# stop reading from a client while this much output is unsent
+OUT_LIMIT = 1 << 20
+
+debug = False
+
+# gets naming at least this many queues use a cached Shape
+SHAPE_MIN = 16
+MAX_SHAPES = 1024
 
 class Queue:
 
-    def __init__(self):
-        self.q = PriorityQueue()
-        self.counter = 0
-        self.waiters = set()
+    # heapq of (-pri, id, data). Deleted jobs are dropped from `jobs` and left
+    # in the heap; peek discards them from the top and the heap is rebuilt
+    # once they make up more than half of it.
+
+    def __init__(self, name):
+        self.name = name
+        self.name_json = json.dumps(name).encode('utf8')
+        self.heap = []
+        self.dead = 0
+        self.waiters = deque()
+        self.compact_at = 64
+        self.shapes = set()
 
     def put(self, pri, data):
         global job_counter
         id = job_counter
-        job_counter += 1
-        self.q.put((-pri, id, data))
-        valid_jobs.add(id)
+        job_counter += id_step
+        self.insert(id, -pri, data)
         return id
 
     def insert(self, id, pri, data):
-        self.q.put((pri, id, data))
-        valid_jobs.add(id)
+        heapq.heappush(self.heap, (pri, id, data))
+        jobs[id] = self
+        if self.shapes and self.peek()[0] == id:
+            for shape in self.shapes:
+                shape.push(pri, id, self.name)
 
     def peek(self):
-        while True:
-            try:
-                job = self.q.get_nowait()
-            except Empty:
-                return None
-            id = job[1]
-            if id in valid_jobs:
-                break
-        self.q.put(job)
-        pri, id, data = job
-        return id, pri, data
+        heap = self.heap
+        while heap:
+            pri, id, data = heap[0]
+            if id in jobs:
+                return id, pri, data
+            heapq.heappop(heap)
+            self.dead -= 1
+        return None
 
     def pop(self):
-        pri, id, data = self.q.get_nowait()
-        assert id in valid_jobs
-        valid_jobs.remove(id)
+        self.peek()
+        pri, id, data = heapq.heappop(self.heap)
+        del jobs[id]
         return id, pri, data
 
+    def remove(self, id):
+        del jobs[id]
+        self.dead += 1
+        if self.dead > 64 and self.dead * 2 > len(self.heap):
+            self.heap = [job for job in self.heap if job[1] in jobs]
+            heapq.heapify(self.heap)
+            self.dead = 0
+
     def add_wait(self, wait):
-        self.waiters.add(wait)
+        self.waiters.append(wait)
+        if len(self.waiters) >= self.compact_at:
+            self.waiters = deque(w for w in self.waiters if w.active)
+            self.compact_at = max(64, 2 * len(self.waiters))
+
+    def next_wait(self):
+        waiters = self.waiters
+        while waiters:
+            wait = waiters.popleft()
+            if wait.active:
+                return wait
+        return None
+
+class Queues(dict):
+
+    def __missing__(self, name):
+        queue = self[name] = Queue(name)
+        return queue
+
+queues = Queues()
+
+class Shape:
+
+    # Heap of queue heads for one list of queue names. Every non-empty queue
+    # has an entry no worse than its current head: a new head is pushed by
+    # Queue.insert, and entries left behind by pops and deletes are replaced
+    # with the queue's current head when they reach the top.
+
+    def __init__(self, names):
+        self.names = names
+        self.rebuild()
+        for name in names:
+            queues[name].shapes.add(self)
+
+    def rebuild(self):
+        self.heap = []
+        for name in self.names:
+            job = queues[name].peek()
+            if job is not None:
+                id, pri, data = job
+                self.heap.append((pri, id, name))
+        heapq.heapify(self.heap)
+
+    def push(self, pri, id, name):
+        heapq.heappush(self.heap, (pri, id, name))
+        if len(self.heap) > 2 * len(self.names) + 64:
+            self.rebuild()
+
+    def best(self):
+        heap = self.heap
+        while heap:
+            pri, id, name = heap[0]
+            job = queues[name].peek()
+            if job is None:
+                heapq.heappop(heap)
+            elif job[0] == id:
+                return name
+            else:
+                heapq.heapreplace(heap, (job[1], job[0], name))
+        return None
+
+    def drop(self):
+        for name in self.names:
+            queues[name].shapes.discard(self)
+
+shapes = OrderedDict()
+
+def best_queue(names):
+    if len(names) < SHAPE_MIN:
+        highest = None
+        highest_queue = None
+        for queue in names:
+            job = queues[queue].peek()
+            if job is not None:
+                id, pri, data = job
+                if highest is None or pri < highest:
+                    highest = pri
+                    highest_queue = queue
+        return highest_queue
+    key = tuple(names)
+    shape = shapes.get(key)
+    if shape is None:
+        shape = shapes[key] = Shape(key)
+        if len(shapes) > MAX_SHAPES:
+            shapes.popitem(last=False)[1].drop()
+    else:
+        shapes.move_to_end(key)
+    return shape.best()
+
+class PutTimes:
+
+    # When jobs were put, without storing a time per job: at the end of each
+    # loop pass that handed out ids, the next id and the time are marked, so
+    # a job was put no later than the first mark above its id. Once there
+    # are too many marks every other one in the older half is dropped, so an
+    # age is only ever out by a fraction of itself.
+
+    MAX_MARKS = 4096
 
-    def remove_wait(self, wait):
-        self.waiters.discard(wait)
+    def __init__(self):
+        self.ids = []
+        self.times = []
+
+    def mark(self, next_id, t):
+        if self.ids and self.ids[-1] == next_id:
+            return
+        self.ids.append(next_id)
+        self.times.append(t)
+        if len(self.ids) > self.MAX_MARKS:
+            half = len(self.ids) // 2
+            self.ids = self.ids[:half:2] + self.ids[half:]
+            self.times = self.times[:half:2] + self.times[half:]
+
+    def age(self, id):
+        i = bisect.bisect_right(self.ids, id)
+        return now - self.times[i] if i < len(self.times) else 0.0
+
+put_times = PutTimes()
+# time at the start of the current loop pass
+now = time.monotonic()
+# put -> assign latencies of one assignment in LATENCY_SAMPLE; bucket b
+# counts those under 2**b microseconds
+LATENCY_SAMPLE = 16
+latency = [0] * 64
+assigns = 0
+
+class Journal:
+
+    # Jobs are logged as JSON lines: ["put", id, queue, pri, job text],
+    # ["delete", id] and ["next", job_counter]. The log is split into numbered
+    # segments; a forked child writes a snapshot of every live job and removes
+    # the segments it covers. Assignments are not logged since a restart
+    # hands every job that was not deleted back to its queue.
+
+    SNAPSHOT_EVERY = 1000000
+    READ_SIZE = 1 << 24
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.buf = []
+        self.records = 0
+        self.child = None
+        os.makedirs(dir, exist_ok=True)
+
+    def segments(self):
+        nums = []
+        for name in os.listdir(self.dir):
+            prefix, _, num = name.partition('.')
+            if prefix == 'wal' and num.isdigit():
+                nums.append(int(num))
+        return sorted(nums)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def read(self, path):
+        # parse a block of lines per json.loads call; anything after the last
+        # newline is a torn write
+        with open(path, 'rb') as f:
+            tail = b''
+            while True:
+                block = f.read(self.READ_SIZE)
+                if not block:
+                    return
+                end = block.rfind(b'\n')
+                if end < 0:
+                    tail += block
+                    continue
+                lines = tail + block[:end]
+                tail = block[end + 1:]
+                try:
+                    yield from json.loads(b'[' + lines.replace(b'\n', b',') + b']')
+                except ValueError:
+                    for line in lines.split(b'\n'):
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            return
+
+    def recover(self):
+        global job_counter
+        # the snapshot and an older segment can both hold a job, so only the
+        # last entry recorded for an id is kept
+        latest = {}
+        heaps = {}
+        next_id = 0
+        snapshot = self.path('snapshot')
+        segments = self.segments()
+        paths = [self.path('wal.%d' % num) for num in segments]
+        if os.path.exists(snapshot):
+            paths.insert(0, snapshot)
+        gc.disable()
+        try:
+            for path in paths:
+                count = 0
+                for count, record in enumerate(self.read(path), 1):
+                    op = record[0]
+                    if op == 'put':
+                        op, id, queue, pri, data = record
+                        job = latest[id] = (-pri, id, data)
+                        heaps.setdefault(queue, []).append(job)
+                        if id >= next_id:
+                            next_id = id + 1
+                    elif op == 'delete':
+                        latest.pop(record[1], None)
+                    elif op == 'next':
+                        next_id = max(next_id, record[1])
+                if path != snapshot:
+                    self.records += count
+            for name, heap in heaps.items():
+                heap = [job for job in heap if latest.get(job[1]) is job]
+                heapq.heapify(heap)
+                queue = queues[name]
+                queue.heap = heap
+                jobs.update(dict.fromkeys([job[1] for job in heap], queue))
+        finally:
+            # keep the collector from rescanning the recovered jobs, here and
+            # in a forked snapshot child
+            gc.freeze()
+            gc.enable()
+        job_counter = next_id
+        self.segment = segments[-1] + 1 if segments else 0
+        self.open_segment()
+        return len(latest)
+
+    def open_segment(self):
+        self.wal = open(self.path('wal.%d' % self.segment), 'ab')
+        self.sync_dir()
+
+    def sync_dir(self):
+        fd = os.open(self.dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def put(self, id, queue, pri, data):
+        self.buf.append(json.dumps(['put', id, queue, pri, data]))
+
+    def delete(self, id):
+        self.buf.append('["delete", %d]' % id)
 
-queues = defaultdict(Queue)
+    def flush(self):
+        # called once per event loop iteration, so one fsync covers every
+        # request handled in it
+        if self.buf:
+            self.wal.write(('\n'.join(self.buf) + '\n').encode('utf8'))
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            self.records += len(self.buf)
+            self.buf.clear()
+        if self.child is not None:
+            pid, status = os.waitpid(self.child, os.WNOHANG)
+            if pid:
+                if status:
+                    print("Snapshot failed, keeping the log")
+                self.child = None
+        elif self.records >= self.SNAPSHOT_EVERY:
+            self.snapshot()
+
+    def snapshot(self):
+        self.wal.close()
+        upto = self.segment
+        self.segment += 1
+        self.open_segment()
+        self.records = 0
+        self.child = os.fork()
+        if self.child == 0:
+            try:
+                close_sockets()
+                self.write_snapshot(upto)
+                os._exit(0)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(1)
+
+    def write_snapshot(self, upto):
+        tmp = self.path('snapshot.tmp')
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(['next', job_counter]) + '\n')
+            for queue in queues.values():
+                for pri, id, data in queue.heap:
+                    if id in jobs:
+                        f.write(json.dumps(['put', id, queue.name, -pri, data]) + '\n')
+            for id, client in assigned.items():
+                job = client.working_on[id]
+                f.write(json.dumps(['put', id, job['queue'], -job['pri'], job['data']]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path('snapshot'))
+        self.sync_dir()
+        for num in self.segments():
+            if num <= upto:
+                os.remove(self.path('wal.%d' % num))
+
+journal = None
+
+selector = selectors.EpollSelector()
+
+def close_sockets():
+    # in a forked snapshot writer, so that the listener, clients and shard
+    # links don't stay open until it is done
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    for shard in shards:
+        shard.sock.close()
+    if shard_sock is not None:
+        shard_sock.close()
 
 def register_client(sock):
     no = sock.fileno()
-    clients[no] = Client(sock, bytearray(), {}, set())
+    clients[no] = Client(sock, bytearray(), {}, set(), bytearray(), deque(), deque())
+    selector.register(sock, selectors.EVENT_READ)
 
 def on_disconnect(client):
-    for id, job in client.working_on.items():
-        del assigned[id]
-        queues[job['queue']].insert(id, job['pri'], job['data'])
+    released = release_jobs(client)
     for wait in client.waits:
-        for queue in wait.queues:
-            queues[queue].remove_wait(wait)
+        wait.active = False
     no = client.sock.fileno()
+    if client.out:
+        # last replies to a client that has stopped sending
+        if journal is not None:
+            journal.flush()
+        try:
+            client.sock.send(client.out)
+        except OSError:
+            pass
+    pending.discard(no)
+    selector.unregister(client.sock)
     client.sock.close()
     del clients[no]
-    for job in client.working_on.values():
-        if queues[job['queue']].waiters:
-            wait = queues[job['queue']].waiters.pop()
-            process_wait(wait, job['queue'])
+    if shards:
+        for shard in shards:
+            shard.call(('gone', no), on_requeued)
+    for queue in released:
+        wake(queue)
+
+def release_jobs(client):
+    for id, job in client.working_on.items():
+        del assigned[id]
+        queues[job['queue']].insert(id, job['pri'], job['data'])
+    return [job['queue'] for job in client.working_on.values()]
+
+def wake(queue):
+    wait = queues[queue].next_wait()
+    if wait is not None:
+        process_wait(wait, queue)
 
 def process_wait(wait, queue):
+    wait.active = False
     client = clients[wait.client_id]
     client.waits.remove(wait)
-    for queue in wait.queues:
-        queues[queue].remove_wait(wait)
     pop_job_to_client(client, queue)
 
 def pop_job_to_client(client, queue):
+    job_id, pri, data = assign(client, queue)
+    reply(client, job_reply(job_id, pri, queue, data))
+
+def assign(client, queue):
+    global assigns
     job_id, pri, data = queues[queue].pop()
+    assigns += 1
+    if assigns % LATENCY_SAMPLE == 0:
+        latency[int(put_times.age(job_id) * 1e6).bit_length()] += 1
     client.working_on[job_id] = { 'id': job_id, 'pri': pri, 'data': data, 'queue': queue }
     assigned[job_id] = client
-    send(client, id=job_id, job=data, pri=-pri, queue=queue)
+    return job_id, pri, data
+
+def job_reply(job_id, pri, queue, data):
+    return b'{"id": %d, "job": %s, "pri": %d, "queue": %s, "status": "ok"}\n' % (
+        job_id, data.encode('utf8'), -pri, queues[queue].name_json)
+
+def put_job(queue, pri, data):
+    job_id = queues[queue].put(pri, data)
+    if journal is not None:
+        journal.put(job_id, queue, pri, data)
+    return job_id
+
+def delete_job(id):
+    if id in jobs:
+        jobs[id].remove(id)
+    elif id in assigned:
+        assigned.pop(id).working_on.pop(id)
+    else:
+        return False
+    if journal is not None:
+        journal.delete(id)
+    return True
 
-def send(client, status='ok', **kwargs):
-    data = json.dumps({ **kwargs, 'status': status })
-    print(">>>", client.sock.fileno(), data)
-    client.sock.sendall(data.encode('utf8') + b'\n')
+def abort_job(client, id):
+    if id not in client.working_on:
+        return None
+    assert assigned.pop(id) is client
+    job = client.working_on.pop(id)
+    queues[job['queue']].insert(id, job['pri'], job['data'])
+    return job['queue']
 
-def send_error(client, msg):
-    send(client, status='error', error=msg)
+def queue_stats():
+    # walks every queue, so this is only for the stats request
+    in_flight = {}
+    for id, client in assigned.items():
+        name = client.working_on[id]['queue']
+        in_flight[name] = in_flight.get(name, 0) + 1
+    rows = {}
+    for name, queue in queues.items():
+        waiters = sum(wait.active for wait in queue.waiters)
+        if queue.heap or waiters or name in in_flight:
+            if queue.dead:
+                oldest = min((id for pri, id, data in queue.heap if id in jobs), default=None)
+            else:
+                oldest = min(queue.heap, key=itemgetter(1), default=(0, None))[1]
+            rows[name] = {
+                'depth': len(queue.heap) - queue.dead,
+                'dead': queue.dead,
+                'in_flight': in_flight.get(name, 0),
+                'waiters': waiters,
+                'oldest': None if oldest is None else round(put_times.age(oldest), 3),
+            }
+    return rows
+
+def stats_reply(rows, hist):
+    return json.dumps({
+        'status': 'ok',
+        'clients': len(clients),
+        'in_flight': sum(row['in_flight'] for row in rows.values()),
+        'queues': rows,
+        # [upper bound in seconds, estimated count] per non-empty bucket
+        'latency': [[(1 << b) / 1e6, n * LATENCY_SAMPLE] for b, n in enumerate(hist) if n],
+    }).encode('utf8') + b'\n'
+
+OK = b'{"status": "ok"}\n'
+NO_JOB = b'{"status": "no-job"}\n'
+
+def reply(client, data):
+    if debug:
+        print(">>>", client.sock.fileno(), data)
+    client.out.extend(data)
+    pending.add(client.sock.fileno())
+
+def error(msg):
+    return b'{"error": %s, "status": "error"}\n' % json.dumps(msg).encode('utf8')
+
+def flush_out(client):
+    try:
+        sent = client.sock.send(client.out)
+    except BlockingIOError:
+        sent = 0
+    except OSError:
+        on_disconnect(client)
+        return
+    del client.out[:sent]
+    events = selectors.EVENT_READ
+    if client.out:
+        events |= selectors.EVENT_WRITE
+        if len(client.out) > OUT_LIMIT:
+            events = selectors.EVENT_WRITE
+    if selector.get_key(client.sock).events != events:
+        selector.modify(client.sock, events)
+
+def flush_pending():
+    # replies made while handling a batch of reads go out together, after
+    # the journal has been synced
+    while pending:
+        client = clients.get(pending.pop())
+        if client is not None:
+            flush_out(client)
 
 def on_response(sock):
     no = sock.fileno()
     client = clients[no]
-    while True:
+    while len(client.out) <= OUT_LIMIT:
         try:
             buf = client.sock.recv(4096)
         except BlockingIOError:
             break
         except IOError:
             on_disconnect(client)
-            return True
+            return
         if not buf:
             on_disconnect(client)
-            return True
+            return
         lines = buf.split(b'\n')
         if len(lines) == 1:
             client.line_buf.extend(buf)
@@ -120,19 +594,91 @@ def on_response(sock):
             first = client.line_buf + lines[0]
             client.line_buf.clear()
             client.line_buf.extend(lines[-1])
-            process_line(client, first)
+            on_line(client, first)
             for line in lines[1:-1]:
-                process_line(client, line)
+                on_line(client, line)
+
+def on_line(client, line):
+    if not shards:
+        process_line(client, line, partial(reply, client))
+    elif client.held:
+        client.held.append(line)
+    else:
+        route_line(client, line)
+
+def route_line(client, line):
+    # with shards, replies come back from the workers out of order, so each
+    # one is held in a slot until the replies before it have gone out
+    slot = [None]
+    client.backlog.append(slot)
+    process_line(client, line, partial(fill, client, slot))
+
+def fill(client, slot, data):
+    slot[0] = data
+    backlog = client.backlog
+    while backlog and backlog[0][0] is not None:
+        data = backlog.popleft()[0]
+        if data:
+            reply(client, data)
+
+def alive(client):
+    return clients.get(client.sock.fileno()) is client
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+decode = json.JSONDecoder().raw_decode
+
+def parse_request(text):
+    # Walks the top-level object so that the job comes back as the exact
+    # JSON text the client sent, to be stored and sent on without being
+    # encoded again. Lines with no job go straight to json.loads.
+    if '"job"' not in text:
+        req = json.loads(text)
+        if type(req) is not dict:
+            raise ValueError("not an object")
+        # the key can still be there written with escapes
+        return req, json.dumps(req['job']) if 'job' in req else None
+    ws = WHITESPACE.match
+    req = {}
+    job = None
+    i = ws(text).end()
+    if text[i:i + 1] != '{':
+        raise ValueError("not an object")
+    i = ws(text, i + 1).end()
+    if text[i:i + 1] == '}':
+        i += 1
+    else:
+        while True:
+            if text[i:i + 1] != '"':
+                raise ValueError("expected key")
+            key, i = decode(text, i)
+            i = ws(text, i).end()
+            if text[i:i + 1] != ':':
+                raise ValueError("expected ':'")
+            start = ws(text, i + 1).end()
+            req[key], i = decode(text, start)
+            if key == 'job':
+                job = text[start:i]
+            i = ws(text, i).end()
+            c = text[i:i + 1]
+            i = ws(text, i + 1).end()
+            if c == '}':
+                break
+            if c != ',':
+                raise ValueError("expected ',' or '}'")
+    if ws(text, i).end() != len(text):
+        raise ValueError("extra data")
+    return req, job
 
-def process_line(client, line):
+def process_line(client, line, respond):
     try:
-        req = json.loads(line)
-    except:
-        send_error(client, "Invalid JSON")
+        req, job = parse_request(line.decode('utf8'))
+    except (ValueError, RecursionError):
+        respond(error("Invalid JSON"))
         return
-    print("<<<", client.sock.fileno(), req)
+    if debug:
+        print("<<<", client.sock.fileno(), req)
     if 'request' not in req:
-        send_error(client, 'Missing \"request\" key')
+        respond(error('Missing \"request\" key'))
         return
     req_type = req['request']
     if req_type == 'put':
@@ -141,94 +687,404 @@ def process_line(client, line):
             pri = req['pri']
             data = req['job']
         except KeyError:
-            send_error(client, 'Missing data')
+            respond(error('Missing data'))
             return
         if type(pri) is not int or pri < 0:
-            send_error(client, 'bad priority')
+            respond(error('bad priority'))
             return
         if type(q) is not str:
-            send_error(client, 'bad queue')
+            respond(error('bad queue'))
             return
         if type(data) is not dict:
-            send_error(client, 'bad job')
+            respond(error('bad job'))
+            return
+        if shards:
+            route_put(respond, q, pri, job)
             return
-        job_id = queues[q].put(pri, data)
-        if queues[q].waiters:
-            wait = queues[q].waiters.pop()
-            process_wait(wait, q)
-        send(client, id=job_id)
+        job_id = put_job(q, pri, job)
+        wake(q)
+        respond(b'{"id": %d, "status": "ok"}\n' % job_id)
     elif req_type == 'get':
         if 'queues' not in req or type(req['queues']) is not list:
-            send_error(client, 'bad request')
+            respond(error('bad request'))
             return
-        highest = None
-        highest_queue = None
-        for queue in req['queues']:
-            job = queues[queue].peek()
-            if job is not None:
-                id, pri, data = job
-                if highest is None or pri < highest:
-                    highest = pri
-                    highest_queue = queue
-        if highest is not None:
-            pop_job_to_client(client, highest_queue)
+        if shards:
+            route_get(client, req['queues'], req.get('wait', False) == True, respond, True)
+            return
+        highest_queue = best_queue(req['queues'])
+        if highest_queue is not None:
+            job_id, pri, data = assign(client, highest_queue)
+            respond(job_reply(job_id, pri, highest_queue, data))
         elif req.get('wait', False) == True:
             wait = Wait(client.sock.fileno(), tuple(req['queues']))
             client.waits.add(wait)
             for queue in req['queues']:
                 queues[queue].add_wait(wait)
+            respond(b'')
         else:
-            send(client, status='no-job')
+            respond(NO_JOB)
     elif req_type == 'delete':
         if 'id' not in req or type(req['id']) is not int:
-            send_error(client, 'bad job ID')
+            respond(error('bad job ID'))
             return
         id = req['id']
-        if id in valid_jobs:
-            valid_jobs.remove(id)
-            send(client)
-        elif id in assigned:
-            assigned.pop(id).working_on.pop(id)
-            send(client)
-        else:
-            send(client, status='no-job')
+        if shards:
+            route_delete(respond, id)
+            return
+        respond(OK if delete_job(id) else NO_JOB)
     elif req_type == 'abort':
         if 'id' not in req or type(req['id']) is not int:
-            send_error(client, 'bad job ID')
+            respond(error('bad job ID'))
             return
         id = req['id']
-        if id not in client.working_on:
-            send(client, status='no-job')
+        if shards:
+            route_abort(client, respond, id)
+            return
+        queue = abort_job(client, id)
+        if queue is None:
+            respond(NO_JOB)
         else:
-            assert assigned.pop(id) is client
-            job = client.working_on.pop(id)
-            queues[job['queue']].insert(id, job['pri'], job['data'])
-            send(client)
+            respond(OK)
+            wake(queue)
+    elif req_type == 'stats':
+        if shards:
+            route_stats(respond)
+            return
+        respond(stats_reply(queue_stats(), latency))
     else:
-        send_error(client, 'Invalid request type')
+        respond(error('Invalid request type'))
         return
 
+FRAME = struct.Struct('!I')
+
+def pack(msg):
+    data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(data)) + data
+
+def unpack(buf):
+    # complete messages at the front of buf, which are removed from it
+    msgs = []
+    pos = 0
+    while len(buf) - pos >= FRAME.size:
+        size, = FRAME.unpack_from(buf, pos)
+        end = pos + FRAME.size + size
+        if end > len(buf):
+            break
+        msgs.append(pickle.loads(buf[pos + FRAME.size:end]))
+        pos = end
+    del buf[:pos]
+    return msgs
+
+def remote_client(no):
+    # a front-end connection as seen by a shard
+    client = clients.get(no)
+    if client is None:
+        client = clients[no] = Client(None, None, {}, set(), None, None, None)
+    return client
+
+def shard_command(op, *args):
+    if op == 'put':
+        return put_job(*args)
+    if op == 'peek':
+        queue = best_queue(args[0])
+        if queue is None:
+            return None
+        id, pri, data = queues[queue].peek()
+        return pri, id, queue
+    if op == 'take':
+        # the best job in `names`, or only the given job if one is named
+        no, names, id = args
+        queue = best_queue(names)
+        if queue is None or id is not None and queues[queue].peek()[0] != id:
+            return None
+        job_id, pri, data = assign(remote_client(no), queue)
+        return job_id, pri, queue, data
+    if op == 'delete':
+        return delete_job(args[0])
+    if op == 'abort':
+        no, id = args
+        return abort_job(remote_client(no), id)
+    if op == 'stats':
+        return queue_stats(), latency
+    if op == 'gone':
+        client = clients.pop(args[0], None)
+        return release_jobs(client) if client is not None else []
+
+def serve_shard(sock, index, count, data_dir):
+    global job_counter, id_step, journal, now, shard_sock
+    shard_sock = sock
+    id_step = count
+    if data_dir:
+        journal = Journal(os.path.join(data_dir, 'shard%d' % index))
+        print("Shard", index, "recovered", journal.recover(), "jobs")
+    job_counter += (index - job_counter) % count
+    buf = bytearray()
+    while True:
+        put_times.mark(job_counter, now)
+        data = sock.recv(1 << 16)
+        if not data:
+            return
+        now = time.monotonic()
+        buf.extend(data)
+        replies = [pack(shard_command(*msg)) for msg in unpack(buf)]
+        if journal is not None:
+            journal.flush()
+        sock.sendall(b''.join(replies))
+
+class Shard:
+
+    # A shard worker as seen from the front-end. It answers calls in order,
+    # so each reply goes to the oldest outstanding callback.
+
+    def __init__(self, sock, pid):
+        self.sock = sock
+        self.pid = pid
+        self.out = bytearray()
+        self.buf = bytearray()
+        self.callbacks = deque()
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, self)
+
+    def call(self, msg, callback):
+        self.out.extend(pack(msg))
+        self.callbacks.append(callback)
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.out)
+        except BlockingIOError:
+            sent = 0
+        del self.out[:sent]
+        events = selectors.EVENT_READ
+        if self.out:
+            events |= selectors.EVENT_WRITE
+        if selector.get_key(self.sock).events != events:
+            selector.modify(self.sock, events)
+
+    def on_ready(self, events):
+        if events & selectors.EVENT_WRITE:
+            self.flush()
+        if events & selectors.EVENT_READ:
+            while True:
+                try:
+                    data = self.sock.recv(1 << 16)
+                except BlockingIOError:
+                    break
+                if not data:
+                    sys.exit("Shard %d exited" % self.pid)
+                self.buf.extend(data)
+            for result in unpack(self.buf):
+                self.callbacks.popleft()(result)
+
+shards = []
+# a shard's end of its link to the front end
+shard_sock = None
+
+# bumped whenever a shard reports a job becoming available, so that a get
+# which found nothing can tell whether it raced with a put
+put_epoch = 0
+
+def shard_for(name):
+    return shards[zlib.crc32(str(name).encode('utf8', 'surrogatepass')) % len(shards)]
+
+def on_requeued(names):
+    global put_epoch
+    if names:
+        put_epoch += 1
+    for name in names:
+        wake_routed(name)
+
+def wake_routed(queue):
+    # like process_wait, the waiter takes from the queue that got the job;
+    # if that job has already gone it goes back to waiting on all of them
+    wait = queues[queue].next_wait()
+    if wait is not None:
+        wait.active = False
+        client = clients[wait.client_id]
+        client.waits.remove(wait)
+        def taken(job):
+            if job is not None:
+                reply(client, job_reply(*job))
+            elif alive(client):
+                route_get(client, wait.queues, True, partial(reply, client))
+        shard_for(queue).call(('take', client.sock.fileno(), [queue], None), taken)
+
+def route_put(respond, queue, pri, data):
+    def done(job_id):
+        global put_epoch
+        put_epoch += 1
+        wake_routed(queue)
+        respond(b'{"id": %d, "status": "ok"}\n' % job_id)
+    shard_for(queue).call(('put', queue, pri, data), done)
+
+def route_get(client, names, wait, respond, hold=False):
+    if not alive(client):
+        return
+    epoch = put_epoch
+    no = client.sock.fileno()
+    groups = {}
+    for name in names:
+        groups.setdefault(shard_for(name), []).append(name)
+
+    def taken(job):
+        if job is not None:
+            respond(job_reply(*job))
+        elif not alive(client):
+            pass
+        elif not wait:
+            respond(NO_JOB)
+        elif put_epoch != epoch:
+            route_get(client, names, wait, respond)
+        else:
+            w = Wait(no, tuple(names))
+            client.waits.add(w)
+            for name in names:
+                queues[name].add_wait(w)
+            respond(b'')
+
+    if len(groups) <= 1:
+        for shard, group in groups.items():
+            shard.call(('take', no, group, None), taken)
+        if not groups:
+            taken(None)
+        return
+
+    # peek every shard, then take the best job from its shard as long as it
+    # is still there; if it has gone, start over. The client's later requests
+    # are held back until then, so that none of them can get in between.
+    if hold:
+        client.held.appendleft(None)
+        respond = partial(unhold, client, respond)
+    heads = []
+    def peeked(head):
+        heads.append(head)
+        if len(heads) < len(groups):
+            return
+        heads_found = [head for head in heads if head is not None]
+        if not heads_found:
+            taken(None)
+            return
+        if not alive(client):
+            return
+        pri, id, queue = min(heads_found)
+        def took(job):
+            if job is None and alive(client):
+                route_get(client, names, wait, respond)
+            else:
+                taken(job)
+        shard_for(queue).call(('take', no, [queue], id), took)
+    for shard, group in groups.items():
+        shard.call(('peek', group), peeked)
+
+def unhold(client, respond, data):
+    respond(data)
+    held = client.held
+    held.popleft()
+    while held and held[0] is not None and alive(client):
+        route_line(client, held.popleft())
+
+def route_delete(respond, id):
+    def done(deleted):
+        respond(OK if deleted else NO_JOB)
+    shards[id % len(shards)].call(('delete', id), done)
+
+def route_abort(client, respond, id):
+    def done(queue):
+        if queue is not None:
+            on_requeued([queue])
+        respond(NO_JOB if queue is None else OK)
+    shards[id % len(shards)].call(('abort', client.sock.fileno(), id), done)
+
+def route_stats(respond):
+    # queues and latencies come from the shards, waiters from the front end
+    results = []
+    def done(result):
+        results.append(result)
+        if len(results) < len(shards):
+            return
+        rows = {}
+        hist = [0] * len(latency)
+        for shard_rows, shard_hist in results:
+            rows.update(shard_rows)
+            hist = [a + b for a, b in zip(hist, shard_hist)]
+        for name, queue in queues.items():
+            waiters = sum(wait.active for wait in queue.waiters)
+            if waiters:
+                row = rows.setdefault(name, {'depth': 0, 'dead': 0, 'in_flight': 0, 'waiters': 0, 'oldest': None})
+                row['waiters'] = waiters
+        respond(stats_reply(rows, hist))
+    for shard in shards:
+        shard.call(('stats',), done)
+
+def start_shards(count, data_dir):
+    for index in range(count):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                parent.close()
+                for shard in shards:
+                    shard.sock.close()
+                serve_shard(child, index, count, data_dir)
+                os._exit(0)
+            finally:
+                os._exit(1)
+        child.close()
+        shards.append(Shard(parent, pid))
+    # turn a terminate into an exit so the shards are taken down too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--shards', type=int, default=1)
+    args = parser.parse_args()
+    debug = args.debug
+    if args.shards > 1:
+        start_shards(args.shards, args.data_dir)
+    elif args.data_dir:
+        journal = Journal(args.data_dir)
+        print("Recovered", journal.recover(), "jobs")
+        put_times.mark(job_counter, now)
+
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_sock.bind(('0.0.0.0', 9999))
     server_sock.listen()
 
-    selector = selectors.EpollSelector()
     selector.register(server_sock, selectors.EVENT_READ)
     try:
         while True:
             ready = selector.select(timeout=30)
-            for key, _ in ready:
+            now = time.monotonic()
+            for key, events in ready:
                 sock = key.fileobj
                 if sock is server_sock:
                     client, addr = sock.accept()
                     client.setblocking(False)
                     register_client(client)
-                    selector.register(client, selectors.EVENT_READ)
-                else:
-                    disconnect = on_response(sock)
-                    if disconnect:
-                        selector.unregister(sock)
+                    continue
+                if key.data is not None:
+                    key.data.on_ready(events)
+                    continue
+                client = clients.get(key.fd)
+                if client is not None and events & selectors.EVENT_WRITE:
+                    flush_out(client)
+                    client = clients.get(key.fd)
+                if client is not None and events & selectors.EVENT_READ:
+                    on_response(sock)
+            if journal is not None:
+                journal.flush()
+            flush_pending()
+            put_times.mark(job_counter, now)
+            for shard in shards:
+                if shard.out:
+                    shard.flush()
     finally:
         server_sock.close()
+        for shard in shards:
+            try:
+                os.kill(shard.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass